@@ -0,0 +1,166 @@
+import hashlib
+import os
+import threading
+import typing
+import cv2
+import numpy as np
+from numpy import ndarray
+
+from configs import camera_config
+
+
+def trim_image(img: ndarray, width: int, height: int) -> ndarray:
+    image_height, image_width, _ = img.shape
+    if image_width > image_height:
+        img = cv2.resize(
+            img, (int(round(height * image_width / image_height)), height))
+    else:
+        img = cv2.resize(
+            img, (width, int(round(width * image_height / image_width))))
+    image_height, image_width, _ = img.shape
+    return img[round(image_height/2)-round(height/2):round(image_height/2)+round(height/2), round(image_width/2)-round(width/2):round(image_width/2)+round(width/2)]
+
+
+def fit_image(img: ndarray, width: int, height: int, resize: bool = False) -> ndarray:
+    if resize:
+        return cv2.resize(img, (width, height))
+    return trim_image(img, width, height).astype(np.uint8)
+
+
+class AssetCache:
+    '''
+    On-disk cache of decoded and fitted images and videos
+
+    Assets are stored as .npy files and are memory-mapped read-only,
+    so they are loaded instantly and several processes share their pages
+
+    Args:
+        directory (str): folder for cached files
+        max_size (int): size of the folder in megabytes, the least recently used files are removed above it
+    '''
+
+    def __init__(self, directory: str = 'cache', max_size: int = 512):
+        self.directory = directory
+        self.max_size = max_size * 1024 * 1024
+
+    def path(self, source: str, width: int, height: int, resize: bool) -> str:
+        key = f'{os.path.abspath(source)}|{os.path.getmtime(source)}|{width}x{height}|{"resize" if resize else "trim"}'
+        return os.path.join(self.directory, hashlib.sha1(key.encode()).hexdigest() + '.npy')
+
+    def load(self, source: str, width: int, height: int, resize: bool,
+             write: typing.Callable[[str], None]) -> ndarray:
+        '''write(path) must save the fitted asset to the path as .npy file'''
+        path = self.path(source, width, height, resize)
+        if not os.path.exists(path):
+            os.makedirs(self.directory, exist_ok=True)
+            # write to a temporary file first, so other processes never map a half-written file
+            # the same asset can be prepared by several threads at once, so the name includes the thread id
+            temporary_path = f'{path}.{os.getpid()}.{threading.get_ident()}.tmp'
+            try:
+                write(temporary_path)
+                try:
+                    os.replace(temporary_path, path)
+                except OSError:
+                    # another thread or process has already written and mapped the same asset
+                    if not os.path.exists(path):
+                        raise
+            finally:
+                if os.path.exists(temporary_path):
+                    os.remove(temporary_path)
+            self.evict()
+        else:
+            os.utime(path)  # mark the file as recently used
+        return np.load(path, mmap_mode='r')
+
+    def load_video(self, video_path: str, width: int, height: int, resize: bool) -> typing.Optional[ndarray]:
+        if not os.path.exists(self.path(video_path, width, height, resize)):
+            video = cv2.VideoCapture(video_path)
+            frames_count = int(video.get(cv2.CAP_PROP_FRAME_COUNT))
+            video.release()
+            # videos that don't fit into the cache are streamed instead
+            if frames_count <= 0 or frames_count * width * height * 3 > self.max_size:
+                return None
+        return self.load(video_path, width, height, resize,
+                         lambda path: write_video(path, video_path, width, height, resize))
+
+    def evict(self):
+        files = []
+        for name in os.listdir(self.directory):
+            if not name.endswith('.npy'):
+                continue
+            file = os.path.join(self.directory, name)
+            try:
+                files.append((os.path.getmtime(file), os.path.getsize(file), file))
+            except OSError:
+                # the file was removed by another instance
+                continue
+        files.sort()
+        size = sum(file_size for _, file_size, _ in files)
+        # the newest file is never removed
+        for _, file_size, file in files[:-1]:
+            if size <= self.max_size:
+                break
+            try:
+                os.remove(file)
+            except OSError:
+                # the file is still mapped by another instance (Windows doesn't allow to remove it)
+                continue
+            size -= file_size
+
+
+def decode_image(image_path: str, width: int, height: int, resize: bool) -> ndarray:
+    return fit_image(cv2.imread(image_path, cv2.IMREAD_COLOR), width, height, resize)
+
+
+def write_image(path: str, image_path: str, width: int, height: int, resize: bool):
+    with open(path, 'wb') as file:
+        np.save(file, decode_image(image_path, width, height, resize))
+
+
+def write_video(path: str, video_path: str, width: int, height: int, resize: bool):
+    '''Decode the video straight into the .npy file, so it is never fully loaded into memory'''
+    video = cv2.VideoCapture(video_path)
+    frames_count = int(video.get(cv2.CAP_PROP_FRAME_COUNT))
+    frames = None
+    index = 0
+    while index < frames_count:
+        ret, frame = video.read()
+        if ret is not True:
+            break
+        frame = fit_image(frame, width, height, resize)
+        if frames is None:
+            frames = np.lib.format.open_memmap(path, mode='w+', dtype=np.uint8, shape=(frames_count, *frame.shape))
+        frames[index] = frame
+        index += 1
+    video.release()
+    if frames is None:
+        raise ValueError(f'Could not read video {video_path}')
+    frames.flush()
+    if index < frames_count:
+        # the frame count in the file header was wrong, so save only decoded frames
+        short_path = f'{path}.short'
+        short_frames = np.lib.format.open_memmap(short_path, mode='w+', dtype=np.uint8,
+                                                 shape=(index, *frames.shape[1:]))
+        short_frames[:] = frames[:index]
+        short_frames.flush()
+        del frames, short_frames
+        os.replace(short_path, path)
+
+
+asset_cache_config = (camera_config or {}).get('asset_cache', {})
+asset_cache = AssetCache(asset_cache_config.get('directory', 'cache'),
+                         asset_cache_config.get('max_size', 512)) if asset_cache_config.get('enabled') else None
+
+
+def load_image(image_path: str, width: int, height: int, resize: bool = False) -> ndarray:
+    if asset_cache is None:
+        return decode_image(image_path, width, height, resize)
+    return asset_cache.load(image_path, width, height, resize,
+                            lambda path: write_image(path, image_path, width, height, resize))
+
+
+def load_video(video_path: str, width: int, height: int, resize: bool = False) -> typing.Optional[ndarray]:
+    '''Returns all frames of the video as (N, H, W, 3) array, or None if the video must be streamed'''
+    if asset_cache is None:
+        return None
+    return asset_cache.load_video(video_path, width, height, resize)
@@ -1,11 +1,17 @@
+import bisect
+import itertools
+import threading
 import time
+from concurrent.futures import Future, ThreadPoolExecutor
 import pyvirtualcam
 from pyvirtualcam import PixelFormat
 import cv2
 import numpy as np
 from collections import OrderedDict
 
-from filters import Filter
+from filters import Filter, fuse_color_filters
+from stats import MemoryStats
+from metrics import Metrics
 import typing
 
 
@@ -16,7 +22,7 @@ class CameraError(Exception):
 class VirtualCam:
     gui = None
 
-    def __init__(self, camera_id: str):
+    def __init__(self, camera_id: str, memory_stats: dict = None, device: str = None, metrics: dict = None):
         self.vc = cv2.VideoCapture(camera_id)
         if not self.vc.isOpened():
             raise CameraError('Could not open video source')
@@ -26,6 +32,27 @@ class VirtualCam:
         self.height, self.width, _ = frame.shape
         self.fps = self.vc.get(cv2.CAP_PROP_FPS)
         self.global_fps = None
+        self.device = device
+
+        memory_stats = memory_stats or {}
+        self.memory_stats = None
+        if memory_stats.get('enabled'):
+            self.memory_stats = MemoryStats(memory_stats.get('log_interval', 5),
+                                            memory_stats.get('budgets'))
+
+        metrics = metrics or {}
+        self.metrics = None
+        if metrics.get('enabled'):
+            self.metrics = Metrics(metrics.get('port'), metrics.get('log_interval', 10),
+                                   metrics.get('latency_sla'))
+            self.metrics.memory_stats = self.memory_stats
+
+        # filters are prepared on this executor before they are added, so the frame thread never waits for them
+        self.executor = ThreadPoolExecutor(max_workers=2)
+        self.pending_filters = set()
+        self.pending_lock = threading.Lock()
+        # filters are ordered by the time they were added, not by the time they were prepared
+        self.sequence = itertools.count()
 
         self.clear_filters()
 
@@ -34,19 +61,28 @@ class VirtualCam:
 
     def run(self):
         try:
-            with pyvirtualcam.Camera(self.width, self.height, self.fps, fmt=PixelFormat.BGR) as cam:
+            with pyvirtualcam.Camera(self.width, self.height, self.fps, fmt=PixelFormat.BGR, device=self.device) as cam:
                 print(
                     f'Virtual cam started ({self.width}x{self.height} @ {self.fps}fps)')
+                frame_id = 0
                 while self.gui and self.gui.opened:
                     status, in_frame = self.vc.read()
                     if not status:
                         raise CameraError('Error fetching frame')
+                    frame_id += 1
+                    captured = time.monotonic()
 
                     output_frame = self.apply_filters(
                         in_frame, self.filter_list)
+                    filtered = time.monotonic()
                     cam.send(output_frame)
+                    sent = time.monotonic()
                     self.gui.update_preview(output_frame.astype(np.uint8))
 
+                    if self.metrics:
+                        self.metrics.record_frame(frame_id, captured, filtered, sent, time.monotonic(),
+                                                  1/(self.global_fps or self.fps))
+
                     if self.global_fps is None:
                         cam.sleep_until_next_frame()
                     else:
@@ -63,23 +99,61 @@ class VirtualCam:
         for priority, filters in filters_list.items():
             if priority not in [-2, 2] and ignore:
                 continue
-            for filter in filters:
-                new_frame = filter._apply(frame, self.gui)
+            # filters are not fused while memory is measured, so every filter gets its own statistics
+            for filter in filters if self.memory_stats else fuse_color_filters(filters):
+                if self.memory_stats:
+                    new_frame = self.memory_stats.measure(
+                        filter, frame, self.gui)
+                else:
+                    new_frame = filter._apply(frame, self.gui)
                 if new_frame is not None:
                     frame = new_frame
                     if filter.global_fps:
                         self.global_fps = filter.global_fps
                 elif priority == -2:
                     ignore -= 1
+        if self.memory_stats:
+            self.memory_stats.end_frame(
+                [filter for filters in filters_list.values() for filter in filters])
         return frame
 
     # functions, used by gui.py
     def add_filter(self, filter: Filter):
-        self.filter_list[filter.priority].append(filter)
+        filter.sequence = next(self.sequence)
+        self.insert_filter(filter)
+
+    def insert_filter(self, filter: Filter):
+        filters = self.filter_list[filter.priority]
+        index = bisect.bisect([other.sequence for other in filters], filter.sequence)
+        filters.insert(index, filter)
+
+    def prepare_filter(self, filter: Filter):
+        '''Prepare filter on a background thread and add it when it is ready, in the place it was clicked in'''
+        with self.pending_lock:
+            filter.sequence = next(self.sequence)
+            self.pending_filters.add(filter)
+        future = self.executor.submit(filter.prepare, self.width, self.height)
+        future.add_done_callback(lambda future: self.on_filter_ready(filter, future))
+
+    def on_filter_ready(self, filter: Filter, future: Future):
+        # the lock is held until the filter is added, so it can't be removed in between
+        with self.pending_lock:
+            # the filter could be removed while it was prepared
+            if filter not in self.pending_filters:
+                return
+            self.pending_filters.discard(filter)
+            if future.exception() is not None:
+                print(f'Could not prepare {type(filter).__name__}: {future.exception()}')
+                return
+            self.insert_filter(filter)
 
     def remove_filter(self, filter: Filter):
-        if filter in self.filter_list[filter.priority]:
-            self.filter_list[filter.priority].remove(filter)
+        with self.pending_lock:
+            self.pending_filters.discard(filter)
+            if filter in self.filter_list[filter.priority]:
+                self.filter_list[filter.priority].remove(filter)
 
     def clear_filters(self):
-        self.filter_list = OrderedDict({i: [] for i in range(-2, 3)})
+        with self.pending_lock:
+            self.pending_filters.clear()
+            self.filter_list = OrderedDict({i: [] for i in range(-2, 3)})
@@ -1,10 +1,15 @@
 import cv2
 from enum import IntEnum
+from itertools import permutations
 from numpy import ndarray
 import numpy as np
 import random
 import typing
 
+import sources
+from assets import trim_image, fit_image, load_image, load_video
+from regions import BaseRegion, create_region
+
 # Base classes
 
 
@@ -72,10 +77,26 @@ class Filter:
 
         global_fps (int | None): fps of camera output
 
+        name (str | None): name of the button or config entry, used in statistics
+
+        region (`BaseRegion` | None): if set, only this part of the frame is filtered
+
+        batchable (bool): if True, apply can process a stack of frames with (N, H, W, 3) shape at once
+
     Functions:
         _apply: main function, that will be executed by the camera script. It must not be modified
         apply: the function, that applies the filter to the frame
+        set_region: creates the region from config, unless the same region is already created
+        apply_region: applies the filter only to the bounding box of the region and blends it back using the mask
+        batch_supported: checks if the filter can process a stack of frames at once.
+            Such filters don't keep state between frames, so parts of a stack can be processed in parallel
+        _apply_batch: applies the filter to a stack of frames, used by offline rendering
+        apply_batch: the function, that applies batchable filter to a stack of frames
         modify_gui: the function, that applies the filter to gui
+        cached_bytes: size of the frames and images, stored by the filter in its own memory
+        mapped_bytes: size of the memory-mapped files from the asset cache, used by the filter
+        prepare: loads files and builds buffers for frames of the given size, so the first apply is fast.
+            It is called on a background thread before the filter is added to the camera
 
     '''
     priority: int = 0
@@ -83,11 +104,56 @@ class Filter:
     chance: int = 100
     global_fps: typing.Union[int, None] = None
     toggleable: bool = True  # TODO: toggleable
+    name: typing.Optional[str] = None
+    sequence: int = 0  # set by the camera, filters with the same priority are applied in this order
+    region: typing.Optional[BaseRegion] = None
+    region_config: typing.Optional[dict] = None
+    batchable: bool = False
 
     def _apply(self, frame: ndarray, gui) -> typing.Optional[ndarray]:
         if self.chance >= 100 or self.chance >= random.random() * 100:
             self.modify_gui(gui)
-            return self.apply(frame)
+            if self.region is None:
+                return self.apply(frame)
+            return self.apply_region(frame)
+
+    def set_region(self, config: typing.Optional[dict]) -> None:
+        # sliders call __init__ on every change, so the region and its detector are kept if the config is the same
+        if self.region is None or config != self.region_config:
+            self.region = create_region(config)
+            self.region_config = config
+
+    def apply_region(self, frame: ndarray) -> typing.Optional[ndarray]:
+        region = self.region.get(frame)
+        if region is None:
+            return frame
+        (x, y, width, height), mask = region
+        part = frame[y:y+height, x:x+width]
+        new_part = self.apply(part)
+        if new_part is None:
+            return None
+        if mask is not None:
+            new_part = cv2.blendLinear(new_part, part, mask, 1 - mask)
+        frame = np.copy(frame)
+        frame[y:y+height, x:x+width] = new_part
+        return frame
+
+    def batch_supported(self) -> bool:
+        return self.batchable and self.region is None and self.chance >= 100
+
+    def _apply_batch(self, frames: ndarray, gui) -> ndarray:
+        if self.batch_supported():
+            self.modify_gui(gui)
+            return self.apply_batch(frames)
+        # apply the filter frame by frame, if it can't process the whole batch
+        new_frames = []
+        for frame in frames:
+            new_frame = self._apply(frame, gui)
+            new_frames.append(frame if new_frame is None else new_frame)
+        return np.stack(new_frames)
+
+    def apply_batch(self, frames: ndarray) -> ndarray:
+        return self.apply(frames)
 
     def apply(self, frame: ndarray) -> typing.Optional[ndarray]:
         return None
@@ -99,6 +165,26 @@ class Filter:
         # TODO: disable
         return None
 
+    def prepare(self, width: int, height: int) -> None:
+        if self.region is not None:
+            self.region.prepare(width, height)
+
+    def cached_arrays(self) -> typing.List[ndarray]:
+        arrays = []
+        for value in vars(self).values():
+            if isinstance(value, ndarray):
+                arrays.append(value)
+            elif isinstance(value, (list, tuple)):
+                arrays += [item for item in value if isinstance(item, ndarray)]
+        return arrays
+
+    def cached_bytes(self) -> int:
+        # memory-mapped assets are paged in by the OS on demand and shared with other processes, so they aren't counted
+        return sum(array.nbytes for array in self.cached_arrays() if not isinstance(array, np.memmap))
+
+    def mapped_bytes(self) -> int:
+        return sum(array.nbytes for array in self.cached_arrays() if isinstance(array, np.memmap))
+
 # Filters
 
 
@@ -116,34 +202,34 @@ class Pause(Filter):
 
 class MirrorX(Filter):
     priority = 0
+    batchable = True
 
     def apply(self, frame: ndarray) -> ndarray:
         return cv2.flip(frame, 1)
 
+    def apply_batch(self, frames: ndarray) -> ndarray:
+        return np.ascontiguousarray(frames[:, :, ::-1])
+
 
 class MirrorY(Filter):
     priority = 0
+    batchable = True
 
     def apply(self, frame: ndarray) -> ndarray:
         return cv2.flip(frame, 0)
 
+    def apply_batch(self, frames: ndarray) -> ndarray:
+        return np.ascontiguousarray(frames[:, ::-1])
+
 
 class Negative(Filter):
     priority = 0
+    batchable = True
 
     def apply(self, frame: ndarray) -> ndarray:
         return 1 - frame
 
 
-class Grayscale(Filter):
-    priority = 0
-
-    def apply(self, frame: ndarray) -> ndarray:
-        frame = cv2.cvtColor(frame, cv2.COLOR_BGR2GRAY)
-        frame = cv2.cvtColor(frame, cv2.COLOR_GRAY2BGR)
-        return frame
-
-
 class FPS(Filter):
     priority = 0
     sliders = [FPS_Slider(default=3)]
@@ -155,18 +241,6 @@ class FPS(Filter):
         return frame
 
 
-def trim_image(img: ndarray, width: int, height: int) -> ndarray:
-    image_height, image_width, _ = img.shape
-    if image_width > image_height:
-        img = cv2.resize(
-            img, (int(round(height * image_width / image_height)), height))
-    else:
-        img = cv2.resize(
-            img, (width, int(round(width * image_height / image_width))))
-    image_height, image_width, _ = img.shape
-    return img[round(image_height/2)-round(height/2):round(image_height/2)+round(height/2), round(image_width/2)-round(width/2):round(image_width/2)+round(width/2)]
-
-
 class Image(Filter):
     priority = -1
 
@@ -176,14 +250,13 @@ class Image(Filter):
 
         self.image = None
 
+    def prepare(self, width: int, height: int) -> None:
+        self.image = load_image(self.image_path, width, height, self.resize)
+
     def apply(self, frame: ndarray) -> ndarray:
         if self.image is None:
             height, width, _ = frame.shape
-            img = cv2.imread(self.image_path, cv2.IMREAD_COLOR)
-            if self.resize:
-                self.image = cv2.resize(img, (width, height))
-            else:
-                self.image = trim_image(img, width, height)
+            self.prepare(width, height)
         return np.copy(self.image)
 
 
@@ -206,6 +279,8 @@ class Video(Filter):
 
     height, width = None, None
     video = None
+    frames = None  # decoded frames from the asset cache
+    position = 0
 
     def __init__(self, video_path: str, resize: bool = False, global_fps: int = None):
         self.video_path = video_path
@@ -216,22 +291,79 @@ class Video(Filter):
         if self.video:
             self.video.release()
 
+    def prepare(self, width: int, height: int) -> None:
+        self.frames = load_video(self.video_path, width, height, self.resize)
+        if self.frames is None:
+            self.video = cv2.VideoCapture(self.video_path)
+        self.height, self.width = height, width
+
     def apply(self, frame: ndarray) -> ndarray:
         if self.height is None:
-            self.height, self.width, _ = frame.shape
+            height, width, _ = frame.shape
+            self.prepare(width, height)
+        if self.frames is not None:
+            frame = np.copy(self.frames[self.position])
+            self.position = (self.position + 1) % len(self.frames)
+            return frame
         if self.video is None:
             self.video = cv2.VideoCapture(self.video_path)
         if self.video.isOpened():
             ret, frame = self.video.read()
             if ret is True:
-                if self.resize:
-                    return cv2.resize(frame, (self.width, self.height))
-                else:
-                    return trim_image(frame, self.width, self.height).astype(np.uint8)
+                return fit_image(frame, self.width, self.height, self.resize)
         self.video = None
         return self.apply(None)
 
 
+class PictureInPicture(Filter):
+    priority = 1
+    sliders = [SliderProperties('Size', 'size', min=10, max=50, fstring='{name}: {spacing}{value}%')]
+
+    def __init__(self, source: str, size: int = 30, position: str = 'bottom-right', margin: int = 10):
+        '''source - name of a source from camera.json, position - corner, like "top-left"'''
+        self.source = source
+        self.size = size
+        self.position = position
+        self.margin = margin
+
+    def apply(self, frame: ndarray) -> ndarray:
+        inset = sources.latest_frame(self.source)
+        if inset is None:
+            return frame
+        height, width, _ = frame.shape
+        inset_width, inset_height = width * self.size // 100, height * self.size // 100
+        inset = cv2.resize(trim_image(inset, inset_width, inset_height), (inset_width, inset_height),
+                           interpolation=cv2.INTER_AREA)
+
+        vertical, _, horizontal = self.position.partition('-')
+        y = self.margin if vertical == 'top' else height - inset_height - self.margin
+        x = self.margin if horizontal == 'left' else width - inset_width - self.margin
+
+        # frame can be saved by another filter, so don't draw over it
+        frame = np.copy(frame)
+        frame[y:y+inset_height, x:x+inset_width] = inset
+        return frame
+
+
+class SideBySide(Filter):
+    priority = 1
+
+    def __init__(self, source: str):
+        '''source - name of a source from camera.json, that will be placed on the right'''
+        self.source = source
+
+    def apply(self, frame: ndarray) -> ndarray:
+        other = sources.latest_frame(self.source)
+        if other is None:
+            return frame
+        height, width, _ = frame.shape
+        left_width = width // 2
+        right_width = width - left_width
+        left = cv2.resize(trim_image(frame, left_width, height), (left_width, height))
+        right = cv2.resize(trim_image(other, right_width, height), (right_width, height))
+        return np.hstack((left, right))
+
+
 class Interpolation(IntEnum):
     nearest = cv2.INTER_NEAREST   # 0
     lenear = cv2.INTER_LINEAR     # 1
@@ -248,15 +380,16 @@ class Pixelized(Filter):
     sliders = [SliderProperties('Pixelisation', 'pixelisation_k', min=1, max=20, step=1),
                SliderProperties('Interpolation', 'interpolation', min=0, max=4)]
 
-    def __init__(self, pixelisation_k: float = 3, interpolation: Interpolation = 3):
+    def __init__(self, pixelisation_k: float = 3, interpolation: Interpolation = 3, region: dict = None):
         self.pixelisation_k = pixelisation_k
         self.interpolation = interpolation
+        self.set_region(region)
 
     def apply(self, frame: ndarray) -> ndarray:
         height, width, _ = frame.shape
 
         if self.pixelisation_k > 0:
-            frame = cv2.resize(frame, (width//self.pixelisation_k, height // self.pixelisation_k),
+            frame = cv2.resize(frame, (max(width // self.pixelisation_k, 1), max(height // self.pixelisation_k, 1)),
                                interpolation=self.interpolation)
             frame = cv2.resize(frame, (width, height),
                                interpolation=self.interpolation)
@@ -289,8 +422,9 @@ class Blur(Filter):
     priority = 0
     sliders = [SliderProperties('Blur', 'blur_k', min=1, max=100)]
 
-    def __init__(self, blur_k: int = 1):
+    def __init__(self, blur_k: int = 1, region: dict = None):
         self.blur_k = blur_k
+        self.set_region(region)
 
     def apply(self, frame: ndarray) -> ndarray:
         return cv2.blur(frame, (self.blur_k, self.blur_k))
@@ -298,15 +432,204 @@ class Blur(Filter):
 
 class Noise(Filter):
     priority = 0
+    batchable = True
     sliders = [SliderProperties('Density', 'density', min=1, max=255)]
 
-    def __init__(self, density: int = 8):
+    def __init__(self, density: int = 8, region: dict = None):
         self.density = density
+        self.set_region(region)
 
     def apply(self, frame: ndarray) -> ndarray:
-        mask = (np.random.rand(*frame.shape)*self.density).astype(np.uint8)
+        # generate uint8 noise directly, float noise for a batch of frames takes too much memory.
+        # A new generator is used, because the global one is locked and can't be used by several threads at once
+        mask = np.random.default_rng().integers(0, self.density, frame.shape, dtype=np.uint8)
         return frame+mask
 
+# Color filters
+
+
+CHANNELS = np.arange(3)
+
+
+def channel_lut(table: ndarray) -> ndarray:
+    '''Make a (256, 3) uint8 table from a (256,) table, that is the same for all channels'''
+    table = np.clip(np.round(table), 0, 255).astype(np.uint8)
+    return np.repeat(table[:, None], 3, axis=1)
+
+
+def matrix_is_exact(matrix: ndarray) -> bool:
+    '''Check if the matrix only moves channels around, so its result needs no rounding or clipping'''
+    return bool(np.isin(matrix, (0, 1)).all() and (matrix.sum(axis=1) <= 1).all())
+
+
+def apply_color_filters(frame: ndarray, filters: typing.List["ColorFilter"]) -> ndarray:
+    '''
+    Apply color filters with as few passes as possible:
+    adjacent tables are composed into one `cv2.LUT`, and a matrix is composed with the next one
+    only if its result needs no rounding or clipping, so the result is the same as with separate passes
+    '''
+    lut, matrix = None, None
+    for filter in filters:
+        table = filter.lut()
+        if table is not None:
+            if matrix is not None:
+                frame = cv2.transform(frame, matrix)
+                matrix = None
+            lut = table if lut is None else table[lut, CHANNELS]
+        else:
+            if lut is not None:
+                frame = cv2.LUT(frame, lut.reshape(1, 256, 3))
+                lut = None
+            if matrix is not None and not matrix_is_exact(matrix):
+                frame = cv2.transform(frame, matrix)
+                matrix = None
+            color_matrix = filter.matrix().astype(np.float32)
+            matrix = color_matrix if matrix is None else color_matrix @ matrix
+    if lut is not None:
+        frame = cv2.LUT(frame, lut.reshape(1, 256, 3))
+    if matrix is not None:
+        frame = cv2.transform(frame, matrix)
+    return frame
+
+
+def apply_color_filters_batch(frames: ndarray, filters: typing.List["ColorFilter"]) -> ndarray:
+    # color filters work with every pixel separately, so the stack of frames can be processed as one tall image
+    count, height, width, _ = frames.shape
+    frames = apply_color_filters(frames.reshape(count * height, width, 3), filters)
+    return frames.reshape(count, height, width, 3)
+
+
+class ColorFilter(Filter):
+    '''
+    Base class for color filters. Adjacent color filters are fused and applied in a single pass
+
+    Functions:
+        lut: returns (256, 3) uint8 table for B, G and R channels, or None
+        matrix: returns 3x3 matrix for BGR pixels; used if lut returns None
+    '''
+    priority = 0
+    batchable = True
+
+    def lut(self) -> typing.Optional[ndarray]:
+        return None
+
+    def matrix(self) -> ndarray:
+        return np.eye(3)
+
+    def apply(self, frame: ndarray) -> ndarray:
+        return apply_color_filters(frame, [self])
+
+    def apply_batch(self, frames: ndarray) -> ndarray:
+        return apply_color_filters_batch(frames, [self])
+
+
+class ColorChain(Filter):
+    '''Several adjacent color filters, applied as one'''
+
+    batchable = True
+
+    def __init__(self, filters: typing.List[ColorFilter]):
+        self.filters = filters
+        self.priority = filters[0].priority
+
+    def apply(self, frame: ndarray) -> ndarray:
+        return apply_color_filters(frame, self.filters)
+
+    def apply_batch(self, frames: ndarray) -> ndarray:
+        return apply_color_filters_batch(frames, self.filters)
+
+    def cached_bytes(self) -> int:
+        return sum(filter.cached_bytes() for filter in self.filters)
+
+
+def fuse_color_filters(filters: typing.List[Filter]) -> typing.List[Filter]:
+    '''Replace runs of adjacent color filters with a `ColorChain`'''
+    fused = []
+    run = []
+    for filter in filters + [None]:
+        if isinstance(filter, ColorFilter) and filter.chance >= 100:
+            run.append(filter)
+            continue
+        if len(run) > 1:
+            fused.append(ColorChain(run))
+        else:
+            fused.extend(run)
+        run = []
+        if filter is not None:
+            fused.append(filter)
+    return fused
+
+
+class Grayscale(ColorFilter):
+    def matrix(self) -> ndarray:
+        return np.array([[0.114, 0.587, 0.299]] * 3)
+
+
+class Sepia(ColorFilter):
+    def matrix(self) -> ndarray:
+        return np.array([[0.131, 0.534, 0.272],
+                         [0.168, 0.686, 0.349],
+                         [0.189, 0.769, 0.393]])
+
+
+class ChannelSwap(ColorFilter):
+    orders = list(permutations(range(3)))
+    sliders = [SliderProperties('Order', 'order', min=0, max=len(orders)-1)]
+
+    def __init__(self, order: int = 5):
+        '''order - index of the channels permutation, 0 keeps BGR as is'''
+        self.order = order
+
+    def matrix(self) -> ndarray:
+        return np.eye(3)[list(self.orders[self.order])]
+
+
+class Invert(ColorFilter):
+    def lut(self) -> ndarray:
+        return channel_lut(255 - np.arange(256))
+
+
+class Brightness(ColorFilter):
+    sliders = [SliderProperties('Brightness', 'brightness', min=-100, max=100)]
+
+    def __init__(self, brightness: int = 30):
+        self.brightness = brightness
+
+    def lut(self) -> ndarray:
+        return channel_lut(np.arange(256) + self.brightness)
+
+
+class Contrast(ColorFilter):
+    sliders = [SliderProperties('Contrast', 'contrast', min=0, max=300,
+                                fstring='{name}: {spacing}{value}%')]
+
+    def __init__(self, contrast: int = 150):
+        self.contrast = contrast
+
+    def lut(self) -> ndarray:
+        return channel_lut((np.arange(256) - 128) * self.contrast / 100 + 128)
+
+
+class Gamma(ColorFilter):
+    sliders = [SliderProperties('Gamma', 'gamma', min=1, max=50, fstring='{name}: {spacing}{value}/10')]
+
+    def __init__(self, gamma: int = 20):
+        '''gamma - gamma multiplied by 10'''
+        self.gamma = gamma
+
+    def lut(self) -> ndarray:
+        return channel_lut(255 * (np.arange(256) / 255) ** (10 / self.gamma))
+
+
+class Posterize(ColorFilter):
+    sliders = [SliderProperties('Levels', 'levels', min=2, max=32)]
+
+    def __init__(self, levels: int = 4):
+        self.levels = levels
+
+    def lut(self) -> ndarray:
+        return channel_lut(np.arange(256) * self.levels // 256 * 255 / (self.levels - 1))
+
 # GUI filters
 
 
@@ -356,24 +679,40 @@ class FilterPack(Filter):  # TODO add sliders
         self.priority = priority
         self.filters = []
         for filter in filters:
-            args = filter.get('args', [])
-            filter_class: Filter = globals()[filter['filter']]
-            if isinstance(args, dict):
-                filter_class = filter_class(**args)
-            else:
-                filter_class = filter_class(*args)
-            self.filters.append(filter_class)
-            if filter_class.global_fps is not None:
-                self.global_fps = filter_class.global_fps
+            filter = create_filter(filter)
+            self.filters.append(filter)
+            if filter.global_fps is not None:
+                self.global_fps = filter.global_fps
 
     def _apply(self, frame: ndarray, gui) -> typing.Optional[ndarray]:
         if self.chance >= 100 or self.chance >= random.random() * 100:
             self.modify_gui(gui)
             return self.apply(frame, gui)
 
-    def apply(self, frame: ndarray, gui) -> ndarray:
-        for filter in self.filters:
-            new_frame = filter._apply(frame, gui)
+    def apply(self, frame: ndarray, gui, run_filter: typing.Callable = None) -> ndarray:
+        '''run_filter(filter, frame, gui) replaces `filter._apply`, and color filters are not fused if it is set'''
+        for filter in fuse_color_filters(self.filters) if run_filter is None else self.filters:
+            new_frame = filter._apply(frame, gui) if run_filter is None else run_filter(filter, frame, gui)
             if new_frame is not None:
                 frame = new_frame
         return frame
+
+    def cached_bytes(self) -> int:
+        return sum(filter.cached_bytes() for filter in self.filters)
+
+    def prepare(self, width: int, height: int) -> None:
+        for filter in self.filters:
+            filter.prepare(width, height)
+
+
+def create_filter(config: dict) -> Filter:
+    # config must look like this: {'filter': FilterClass, 'args': dict|list}
+    args = config.get('args', [])
+    filter_class: Filter = globals()[config['filter']]
+    if isinstance(args, dict):
+        filter = filter_class(**args)
+    else:
+        filter = filter_class(*args)
+    if config.get('name'):
+        filter.name = config['name']
+    return filter
@@ -36,6 +36,7 @@ class FilterButton(QPushButton):
 
         self.parent = parent
         self.target = target
+        self.name = button_name
 
         self.filter = None
         self.filter_class = getattr(filters, filter_name)
@@ -91,7 +92,8 @@ class FilterButton(QPushButton):
             if self.isChecked():
                 self.filter = self.filter_class(
                     *self.filter_args, **self.filter_kwargs)
-                self.parent.camera.add_filter(self.filter)
+                self.filter.name = self.name
+                self.parent.camera.prepare_filter(self.filter)
             else:
                 self.parent.camera.remove_filter(self.filter)
 
@@ -251,6 +253,7 @@ class CamGUI(QMainWindow):
         self.place_buttons()
         if self.gui_config['preview']['enabled']:
             self.place_frame()
+            self.init_preview()
         self.camera_inited = False  # run filters on the first frame
 
     def place_frame(self):
@@ -324,6 +327,11 @@ class CamGUI(QMainWindow):
             self.layout.addLayout(layout, row, column)
         self.buttons.append(button)
 
+    # build the painter when the frame size is known, so the first preview is not delayed
+    def init_preview(self):
+        if self.camera and isinstance(self.preview_frame, RoundedPreviewLabel) and not self.preview_frame.inited:
+            self.preview_frame.init(QSize(self.camera.width, self.camera.height))
+
     def update_preview(self, image):
         if not self.gui_config['preview']['enabled']:
             return
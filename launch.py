@@ -4,22 +4,29 @@ from PyQt6.QtWidgets import QApplication
 from camera import VirtualCam
 from gui import CamGUI
 from configs import camera_config
+from sources import open_sources, close_sources
 
 
 def main():
     app = QApplication(sys.argv)
     app.setStyleSheet(open('configurations/style.css').read())
+    open_sources(camera_config.get('sources', []))
     gui = CamGUI()
-    camera = VirtualCam(camera_config['camera_id'])
+    camera = VirtualCam(camera_config['camera_id'],
+                        camera_config.get('memory_stats'),
+                        metrics=camera_config.get('metrics'))
     # link camera and gui
     camera.gui = gui
     gui.camera = camera
+    gui.init_preview()
     gui.show()
 
     thread = threading.Thread(target=camera.run)
     thread.start()
 
-    sys.exit(app.exec())
+    exit_code = app.exec()
+    close_sources()
+    sys.exit(exit_code)
 
 
 if __name__ == '__main__':
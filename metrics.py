@@ -0,0 +1,157 @@
+import threading
+import time
+import typing
+from collections import deque
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+
+import sources
+
+STAGES = ['filter', 'send', 'preview']
+
+
+def escape_label(value: str) -> str:
+    '''Escape a label value for Prometheus text format'''
+    return str(value).replace('\\', '\\\\').replace('"', '\\"').replace('\n', '\\n')
+
+
+class Histogram:
+    '''Prometheus-style histogram with cumulative buckets'''
+    buckets = (0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1, 2.5)
+
+    def __init__(self):
+        self.counts = [0] * len(self.buckets)
+        self.count = 0
+        self.sum = 0.0
+
+    def observe(self, value: float):
+        for index, bucket in enumerate(self.buckets):
+            if value <= bucket:
+                self.counts[index] += 1
+        self.count += 1
+        self.sum += value
+
+    def render(self, name: str, labels: str) -> typing.List[str]:
+        lines = [f'{name}_bucket{{{labels},le="{bucket}"}} {count}'
+                 for bucket, count in zip(self.buckets, self.counts)]
+        lines.append(f'{name}_bucket{{{labels},le="+Inf"}} {self.count}')
+        lines.append(f'{name}_sum{{{labels}}} {self.sum:.6f}')
+        lines.append(f'{name}_count{{{labels}}} {self.count}')
+        return lines
+
+
+class Metrics:
+    '''
+    Latency tracing of camera frames
+
+    Every frame gets an id and monotonic timestamps after capture, filtering, sending and preview.
+    Latencies are counted from the capture time
+
+    Args:
+        port (int | None): localhost port for the metrics in Prometheus text format
+        log_interval (float): seconds between two reports in the log
+        latency_sla (float | None): seconds; a warning is printed when 95th percentile of latency is above it
+
+    Functions:
+        record_frame: save timestamps of a frame
+        render: get the metrics in Prometheus text format
+    '''
+
+    def __init__(self, port: int = None, log_interval: float = 10, latency_sla: float = None):
+        self.log_interval = log_interval
+        self.latency_sla = latency_sla
+        self.lock = threading.Lock()
+
+        self.histograms = {stage: Histogram() for stage in STAGES}
+        self.recent = deque(maxlen=1000)  # end-to-end latencies for the log
+        self.frames = 0
+        self.dropped = 0
+        self.last_frame_id = 0
+        self.last_capture = None
+        self.fps = 0.0
+
+        self.log_frames = 0
+        self.last_log = time.monotonic()
+
+        self.memory_stats = None  # `MemoryStats` of the camera, if enabled
+
+        self.server = None
+        if port:
+            self.serve(port)
+
+    def record_frame(self, frame_id: int, captured: float, filtered: float, sent: float, previewed: float,
+                     frame_interval: float):
+        with self.lock:
+            self.histograms['filter'].observe(filtered - captured)
+            self.histograms['send'].observe(sent - captured)
+            self.histograms['preview'].observe(previewed - captured)
+            self.recent.append(previewed - captured)
+            # the camera keeps capturing while we are busy, so a long pause means lost frames
+            if self.last_capture is not None and captured - self.last_capture > 1.5 * frame_interval:
+                self.dropped += round((captured - self.last_capture) / frame_interval) - 1
+            self.last_capture = captured
+            self.last_frame_id = frame_id
+            self.frames += 1
+            self.log_frames += 1
+
+        now = time.monotonic()
+        if now - self.last_log >= self.log_interval:
+            self.fps = self.log_frames / (now - self.last_log)
+            self.log()
+            self.log_frames = 0
+            self.last_log = now
+
+    def percentile(self, percent: float) -> float:
+        latencies = sorted(self.recent)
+        if not latencies:
+            return 0.0
+        return latencies[min(int(len(latencies) * percent / 100), len(latencies) - 1)]
+
+    def log(self):
+        with self.lock:
+            p50, p95 = self.percentile(50), self.percentile(95)
+        print(f'[metrics] frame {self.last_frame_id}: {self.fps:.1f}fps, latency p50 {p50*1000:.1f}ms, '
+              f'p95 {p95*1000:.1f}ms, dropped {self.dropped}')
+        if self.latency_sla is not None and p95 > self.latency_sla:
+            print(f'[metrics] latency is above {self.latency_sla*1000:.0f}ms')
+
+    def render(self) -> str:
+        with self.lock:
+            lines = ['# TYPE webcam_latency_seconds histogram']
+            for stage, histogram in self.histograms.items():
+                lines += histogram.render('webcam_latency_seconds', f'stage="{stage}"')
+            lines += [
+                '# TYPE webcam_frames_total counter', f'webcam_frames_total {self.frames}',
+                '# TYPE webcam_dropped_frames_total counter', f'webcam_dropped_frames_total {self.dropped}',
+                '# TYPE webcam_last_frame_id gauge', f'webcam_last_frame_id {self.last_frame_id}',
+                '# TYPE webcam_fps gauge', f'webcam_fps {self.fps:.2f}',
+            ]
+        if self.memory_stats is not None:
+            lines.append('# TYPE webcam_filter_memory_bytes gauge')
+            for name, stats in self.memory_stats.last_report.items():
+                for kind in ['peak', 'average', 'retained', 'cached', 'mapped']:
+                    lines.append(
+                        f'webcam_filter_memory_bytes{{filter="{escape_label(name)}",kind="{kind}"}} {stats[kind]}')
+        lines.append('# TYPE webcam_source_frames_total counter')
+        for name, source in sources.sources.items():
+            lines.append(f'webcam_source_frames_total{{source="{escape_label(name)}"}} {source.frame_id}')
+        return '\n'.join(lines) + '\n'
+
+    def serve(self, port: int):
+        metrics = self
+
+        class Handler(BaseHTTPRequestHandler):
+            def do_GET(self):
+                body = metrics.render().encode()
+                self.send_response(200)
+                self.send_header('Content-Type', 'text/plain; version=0.0.4')
+                self.send_header('Content-Length', str(len(body)))
+                self.end_headers()
+                self.wfile.write(body)
+
+            def log_message(self, format, *args):
+                # don't print every request
+                pass
+
+        self.server = ThreadingHTTPServer(('127.0.0.1', port), Handler)
+        threading.Thread(target=self.server.serve_forever, daemon=True).start()
+        print(f'Metrics are available at http://127.0.0.1:{port}/metrics')
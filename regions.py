@@ -0,0 +1,207 @@
+import typing
+import cv2
+import numpy as np
+from numpy import ndarray
+
+# region is a bounding box (x, y, width, height) and a float32 mask of its size,
+# mask is None when the whole box must be filtered
+Region = typing.Tuple[typing.Tuple[int, int, int, int], typing.Optional[ndarray]]
+
+
+class RegionError(Exception):
+    '''This exception is thrown when the region config is not valid'''
+
+
+class BaseRegion:
+    '''
+    Base class for regions of interest
+
+    Args:
+        invert (bool): filter everything except the region
+
+    Functions:
+        prepare: load everything the region needs for frames of this size
+        find: returns the region for the frame, or None if the region is empty
+        get: the function, used by filters, which also inverts the region
+    '''
+
+    def __init__(self, invert: bool = False):
+        self.invert = invert
+
+    def prepare(self, width: int, height: int) -> None:
+        return None
+
+    def find(self, frame: ndarray) -> typing.Optional[Region]:
+        return None
+
+    def get(self, frame: ndarray) -> typing.Optional[Region]:
+        region = self.find(frame)
+        if not self.invert:
+            return region
+        height, width, _ = frame.shape
+        mask = np.ones((height, width), np.float32)
+        if region is not None:
+            (x, y, w, h), region_mask = region
+            mask[y:y+h, x:x+w] = 0 if region_mask is None else 1 - region_mask
+        return (0, 0, width, height), mask
+
+
+def clip_box(x: float, y: float, w: float, h: float, width: int, height: int) -> typing.Optional[typing.Tuple[int, int, int, int]]:
+    x0, y0 = max(int(x), 0), max(int(y), 0)
+    x1, y1 = min(int(x + w), width), min(int(y + h), height)
+    if x1 <= x0 or y1 <= y0:
+        return None
+    return x0, y0, x1 - x0, y1 - y0
+
+
+class RectRegion(BaseRegion):
+    '''Static rectangle, coordinates are fractions of the frame size'''
+
+    def __init__(self, x: float = 0.25, y: float = 0.25, width: float = 0.5, height: float = 0.5, invert: bool = False):
+        super().__init__(invert)
+        self.rect = (x, y, width, height)
+
+    def find(self, frame: ndarray) -> typing.Optional[Region]:
+        height, width, _ = frame.shape
+        x, y, w, h = self.rect
+        box = clip_box(x * width, y * height, w * width, h * height, width, height)
+        return (box, None) if box else None
+
+
+class MaskRegion(BaseRegion):
+    '''Grayscale mask image, white pixels are filtered'''
+
+    def __init__(self, path: str, invert: bool = False):
+        super().__init__(invert)
+        self.path = path
+        self.size = None
+        self.region = None
+
+    def prepare(self, width: int, height: int) -> None:
+        mask = cv2.imread(self.path, cv2.IMREAD_GRAYSCALE)
+        if mask is None:
+            raise RegionError(f'Could not open mask {self.path}')
+        mask = cv2.resize(mask, (width, height))
+        x, y, w, h = cv2.boundingRect(mask)
+        self.region = ((x, y, w, h), mask[y:y+h, x:x+w].astype(np.float32) / 255) if w and h else None
+        self.size = (width, height)
+
+    def find(self, frame: ndarray) -> typing.Optional[Region]:
+        height, width, _ = frame.shape
+        if self.size != (width, height):
+            self.prepare(width, height)
+        return self.region
+
+
+class DetectorRegion(BaseRegion):
+    '''
+    Base class for regions, found by a detector
+
+    The detector runs on a downscaled grayscale frame once in `interval` frames,
+    the last found box is used in between
+
+    Args:
+        scale (float): size of the frame for the detector
+        interval (int): run the detector once in this number of frames
+        padding (float): part of the box size added on each side
+    '''
+
+    def __init__(self, scale: float = 0.25, interval: int = 5, padding: float = 0.1, invert: bool = False):
+        super().__init__(invert)
+        self.scale = scale
+        self.interval = interval
+        self.padding = padding
+        self.frames = 0
+        self.region = None
+
+    def detect(self, small_frame: ndarray) -> typing.List[typing.Tuple[int, int, int, int]]:
+        return []
+
+    def find(self, frame: ndarray) -> typing.Optional[Region]:
+        if self.frames % self.interval == 0:
+            height, width, _ = frame.shape
+            small_frame = cv2.cvtColor(cv2.resize(frame, None, fx=self.scale, fy=self.scale,
+                                                  interpolation=cv2.INTER_AREA), cv2.COLOR_BGR2GRAY)
+            boxes = self.detect(small_frame)
+            self.region = None
+            if boxes:
+                # join all boxes into one and scale it back to the frame size
+                x0 = min(x for x, _, _, _ in boxes)
+                y0 = min(y for _, y, _, _ in boxes)
+                x1 = max(x + w for x, _, w, _ in boxes)
+                y1 = max(y + h for _, y, _, h in boxes)
+                pad_x, pad_y = (x1 - x0) * self.padding, (y1 - y0) * self.padding
+                box = clip_box((x0 - pad_x) / self.scale, (y0 - pad_y) / self.scale,
+                               (x1 - x0 + 2 * pad_x) / self.scale, (y1 - y0 + 2 * pad_y) / self.scale,
+                               width, height)
+                self.region = (box, None) if box else None
+        self.frames += 1
+        return self.region
+
+
+class MotionRegion(DetectorRegion):
+    '''Part of the frame, that changed since the last detection'''
+
+    def __init__(self, threshold: int = 25, **kwargs):
+        super().__init__(**kwargs)
+        self.threshold = threshold
+        self.previous = None
+
+    def detect(self, small_frame: ndarray) -> typing.List[typing.Tuple[int, int, int, int]]:
+        previous, self.previous = self.previous, small_frame
+        if previous is None or previous.shape != small_frame.shape:
+            return []
+        _, motion = cv2.threshold(cv2.absdiff(previous, small_frame), self.threshold, 255, cv2.THRESH_BINARY)
+        x, y, w, h = cv2.boundingRect(cv2.dilate(motion, None, iterations=2))
+        return [(x, y, w, h)] if w and h else []
+
+
+class FaceRegion(DetectorRegion):
+    '''Faces, found by the Haar cascade from OpenCV. The region is empty if OpenCV has no cascade classifier'''
+
+    def __init__(self, scale: float = 0.5, padding: float = 0.3, **kwargs):
+        super().__init__(scale=scale, padding=padding, **kwargs)
+        self.classifier = None
+        self.loaded = False
+
+    def prepare(self, width: int, height: int) -> None:
+        if not self.loaded:
+            self.load_classifier()
+
+    def load_classifier(self):
+        self.loaded = True
+        if not hasattr(cv2, 'CascadeClassifier') or not hasattr(cv2, 'data'):
+            print('Face detection is not available in this version of OpenCV, face regions will be empty')
+            return
+        classifier = cv2.CascadeClassifier(
+            cv2.data.haarcascades + 'haarcascade_frontalface_default.xml')
+        if classifier.empty():
+            print('Could not load the face detector, face regions will be empty')
+            return
+        self.classifier = classifier
+
+    def detect(self, small_frame: ndarray) -> typing.List[typing.Tuple[int, int, int, int]]:
+        if not self.loaded:
+            self.load_classifier()
+        if self.classifier is None:
+            return []
+        return [tuple(face) for face in self.classifier.detectMultiScale(small_frame, 1.2, 4)]
+
+
+region_types = {
+    'rect': RectRegion,
+    'mask': MaskRegion,
+    'motion': MotionRegion,
+    'face': FaceRegion,
+}
+
+
+def create_region(config: typing.Optional[dict]) -> typing.Optional[BaseRegion]:
+    # config must look like this: {'type': 'rect'|'mask'|'motion'|'face', **args}
+    if config is None:
+        return None
+    config = dict(config)
+    region_type = config.pop('type', 'rect')
+    if region_type not in region_types:
+        raise RegionError(f'Unknown region type {region_type}')
+    return region_types[region_type](**config)
@@ -0,0 +1,142 @@
+import argparse
+import os
+import queue
+import threading
+import time
+from concurrent.futures import ThreadPoolExecutor
+import typing
+from collections import OrderedDict
+import cv2
+import numpy as np
+
+from configs import load_config
+from filters import Filter, create_filter, fuse_color_filters
+
+
+class RenderError(Exception):
+    '''Base exception for offline rendering'''
+
+
+def load_filters(names: typing.List[str] = None) -> typing.List[Filter]:
+    '''Create filters from gui.json buttons with the given names, or from enabled buttons if names are not set'''
+    buttons = [button for row in load_config('gui')['buttons'] for button in row
+               if isinstance(button, dict) and button.get('filter') and not button['filter'].startswith('_')]
+    if names is None:
+        targets = [button for button in buttons if button.get('enabled')]
+    else:
+        targets = []
+        for name in names:
+            matches = [button for button in buttons if (button.get('name') or button['filter']) == name]
+            if not matches:
+                raise RenderError(f'There is no button {name} in gui.json')
+            targets.append(matches[0])
+
+    filter_list = OrderedDict({i: [] for i in range(-2, 3)})
+    for target in targets:
+        filter = create_filter(target)
+        if filter.priority == -2:
+            # these filters control the interface, so they are useless offline
+            print(f'{type(filter).__name__} is skipped, because it only works with the interface')
+            continue
+        filter_list[filter.priority].append(filter)
+    return [filter for filters in filter_list.values() for filter in fuse_color_filters(filters)]
+
+
+def read_batches(video: cv2.VideoCapture, batch_size: int, batches: queue.Queue):
+    while True:
+        frames = []
+        while len(frames) < batch_size:
+            status, frame = video.read()
+            if not status:
+                break
+            frames.append(frame)
+        if frames:
+            batches.put(np.stack(frames))
+        if len(frames) < batch_size:
+            break
+    batches.put(None)
+
+
+def write_batches(writer: cv2.VideoWriter, batches: queue.Queue):
+    while True:
+        frames = batches.get()
+        if frames is None:
+            break
+        for frame in frames:
+            writer.write(frame)
+
+
+def apply_batch(filter: Filter, frames: np.ndarray, pool: ThreadPoolExecutor, workers: int) -> np.ndarray:
+    if not filter.batch_supported() or len(frames) < 2:
+        return filter._apply_batch(frames, None)
+    # numpy and OpenCV release the GIL, so parts of the stack are processed on several cores
+    parts = [part for part in np.array_split(frames, min(workers, len(frames))) if len(part)]
+    return np.concatenate(list(pool.map(lambda part: filter._apply_batch(part, None), parts)))
+
+
+def render(input_path: str, output_path: str, filters: typing.List[Filter], batch_size: int = 16):
+    '''
+    Apply filters to a video file as fast as possible
+
+    Frames are decoded, filtered and encoded on separate threads.
+    Filters are applied to stacks of `batch_size` frames. Filters with batch support process parts of the stack
+    on all cores at once, other filters keep state between frames, so they process frames one by one
+    '''
+    if batch_size < 1:
+        raise RenderError('Batch size must be at least 1')
+    video = cv2.VideoCapture(input_path)
+    if not video.isOpened():
+        raise RenderError(f'Could not open video {input_path}')
+    fps = video.get(cv2.CAP_PROP_FPS) or 30
+    width, height = int(video.get(cv2.CAP_PROP_FRAME_WIDTH)), int(video.get(cv2.CAP_PROP_FRAME_HEIGHT))
+    writer = cv2.VideoWriter(output_path, cv2.VideoWriter_fourcc(*'mp4v'), fps, (width, height))
+    if not writer.isOpened():
+        video.release()
+        raise RenderError(f'Could not write video {output_path}')
+
+    input_batches = queue.Queue(maxsize=4)
+    output_batches = queue.Queue(maxsize=4)
+    reader = threading.Thread(target=read_batches, args=(video, batch_size, input_batches), daemon=True)
+    writer_thread = threading.Thread(target=write_batches, args=(writer, output_batches), daemon=True)
+    reader.start()
+    writer_thread.start()
+
+    workers = os.cpu_count() or 1
+    pool = ThreadPoolExecutor(max_workers=workers)
+    frames_count = 0
+    start = time.monotonic()
+    try:
+        while True:
+            frames = input_batches.get()
+            if frames is None:
+                break
+            for filter in filters:
+                frames = apply_batch(filter, frames, pool, workers)
+            output_batches.put(frames.astype(np.uint8))
+            frames_count += len(frames)
+    finally:
+        pool.shutdown()
+        output_batches.put(None)
+        writer_thread.join()
+        writer.release()
+        video.release()
+
+    elapsed = time.monotonic() - start
+    print(f'Rendered {frames_count} frames in {elapsed:.1f}s ({frames_count / elapsed:.1f} frames/s)')
+
+
+def main():
+    parser = argparse.ArgumentParser(description='Apply filters from gui.json to a video file')
+    parser.add_argument('input', help='video file to read')
+    parser.add_argument('output', help='video file to write')
+    parser.add_argument('--buttons', nargs='+',
+                        help='names of buttons from gui.json, enabled buttons are used by default')
+    parser.add_argument('--batch-size', type=int, default=16, help='number of frames processed at once')
+    args = parser.parse_args()
+    if args.batch_size < 1:
+        parser.error('--batch-size must be at least 1')
+    render(args.input, args.output, load_filters(args.buttons), args.batch_size)
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,147 @@
+import multiprocessing
+import os
+import time
+import typing
+
+from camera import VirtualCam, CameraError
+from configs import load_config
+from filters import create_filter
+from sources import SourceError, open_sources, close_sources
+
+
+class HeadlessSignal:
+    '''Stand-in for Qt signals of `CamGUI`'''
+
+    def emit(self):
+        pass
+
+
+class HeadlessGUI:
+    '''Stand-in for `CamGUI`, used by pipelines that run without a window'''
+    opened = True
+    buttons = []
+    reloaded = HeadlessSignal()
+
+    def __init__(self, frames: "multiprocessing.Value"):
+        self.frames = frames
+
+    def update_preview(self, image):
+        # there is no preview, so only count frames for the stats
+        with self.frames.get_lock():
+            self.frames.value += 1
+
+    def clear_filters(self):
+        pass
+
+
+def run_pipeline(config: dict, frames: "multiprocessing.Value", cpus: typing.List[int] = None):
+    if cpus and hasattr(os, 'sched_setaffinity'):
+        try:
+            os.sched_setaffinity(0, cpus)
+        except OSError as error:
+            # the cpus from affinity are not available for this process
+            print(f'[{config["name"]}] Could not set CPU affinity {cpus}: {error}')
+            return
+    try:
+        open_sources(config.get('sources', []))
+        camera = VirtualCam(config['camera_id'], config.get(
+            'memory_stats'), config.get('device'), config.get('metrics'))
+        camera.gui = HeadlessGUI(frames)
+        # filters must look like this: [{'filter': FilterClass, 'args': dict|list}]
+        for filter_config in config.get('filters', []):
+            camera.add_filter(create_filter(filter_config))
+        camera.run()
+    except (CameraError, SourceError) as error:
+        print(f'[{config["name"]}] {error}')
+    finally:
+        close_sources()
+
+
+def available_cores() -> typing.List[int]:
+    # a container can allow only some of the cores to this process
+    if hasattr(os, 'sched_getaffinity'):
+        return sorted(os.sched_getaffinity(0))
+    return list(range(os.cpu_count() or 1))
+
+
+class Pipeline:
+    '''A single virtual camera, running in its own process'''
+
+    def __init__(self, config: dict, cpus: typing.List[int] = None):
+        self.name = config['name']
+        self.config = config
+        self.cpus = cpus
+        self.frames = multiprocessing.Value('L', 0)
+        self.last_frames = 0
+        self.process = multiprocessing.Process(
+            target=run_pipeline, args=(config, self.frames, cpus), name=self.name, daemon=True)
+
+    def start(self):
+        self.process.start()
+
+    def stop(self):
+        self.process.terminate()
+        self.process.join()
+
+    def stats(self, interval: float) -> typing.Dict[str, typing.Union[str, float, bool]]:
+        frames = self.frames.value
+        fps = (frames - self.last_frames) / interval
+        self.last_frames = frames
+        return {'name': self.name, 'alive': self.process.is_alive(), 'frames': frames, 'fps': fps}
+
+
+class Supervisor:
+    '''
+    Runs several pipelines from "server.json" on one host
+
+    Pipelines use the same asset cache, so decoded images and videos are shared between them
+
+    Args:
+        pipelines (list[dict]): name, camera_id, device, filters, and optional sources and affinity (list of cpu ids)
+            of each pipeline
+        pin_cpus (bool): spread pipelines without affinity over the cores, one core per pipeline
+        stats_interval (float): seconds between two stats reports
+    '''
+
+    def __init__(self, pipelines: typing.List[dict], pin_cpus: bool = False, stats_interval: float = 5):
+        self.stats_interval = stats_interval
+        available_cpus = available_cores()
+        if len(pipelines) > len(available_cpus):
+            print(f'{len(pipelines)} pipelines are started on {len(available_cpus)} cores, '
+                  'some of them will share a core')
+        self.pipelines = []
+        for index, config in enumerate(pipelines):
+            cpus = config.get('affinity')
+            if cpus is None and pin_cpus:
+                cpus = [available_cpus[index % len(available_cpus)]]
+            self.pipelines.append(Pipeline(config, cpus))
+
+    def run(self):
+        for pipeline in self.pipelines:
+            pipeline.start()
+        try:
+            while any(pipeline.process.is_alive() for pipeline in self.pipelines):
+                time.sleep(self.stats_interval)
+                for stats in self.stats():
+                    state = 'running' if stats['alive'] else 'stopped'
+                    print(f'[{stats["name"]}] {state}, {stats["fps"]:.1f}fps, {stats["frames"]} frames')
+        except KeyboardInterrupt:
+            pass
+        finally:
+            for pipeline in self.pipelines:
+                pipeline.stop()
+
+    def stats(self) -> typing.List[dict]:
+        return [pipeline.stats(self.stats_interval) for pipeline in self.pipelines]
+
+
+def main():
+    server_config = load_config('server') or {}
+    supervisor = Supervisor(server_config.get('pipelines', []),
+                            server_config.get('pin_cpus', False),
+                            server_config.get('stats_interval', 5))
+    supervisor.run()
+
+
+if __name__ == '__main__':
+    main()
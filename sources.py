@@ -0,0 +1,79 @@
+import threading
+import time
+import typing
+import cv2
+from numpy import ndarray
+
+
+class SourceError(Exception):
+    '''This exception is thrown when an additional capture source can't be opened'''
+
+
+class CaptureSource:
+    '''
+    Additional video source (camera or video file), captured on its own thread
+
+    Only the latest frame is kept, so readers never wait for a slow source
+
+    Args:
+        source (int | str): camera id or path to a video file
+        name (str): name of the source, used by filters
+    '''
+
+    def __init__(self, source: typing.Union[int, str], name: str = None):
+        self.source = source
+        self.name = name or str(source)
+        self.vc = cv2.VideoCapture(source)
+        if not self.vc.isOpened():
+            raise SourceError(f'Could not open video source {self.name}')
+        # video files are read as fast as possible, so they must be slowed down to their own fps
+        self.is_file = isinstance(source, str) and not source.isdigit()
+        self.fps = self.vc.get(cv2.CAP_PROP_FPS) or 30
+
+        self.frame: typing.Optional[ndarray] = None
+        self.frame_id = 0
+        self.running = True
+        self.thread = threading.Thread(target=self.run, daemon=True)
+        self.thread.start()
+
+    def run(self):
+        while self.running:
+            status, frame = self.vc.read()
+            if not status:
+                if self.is_file:
+                    # start the video from the beginning
+                    self.vc.set(cv2.CAP_PROP_POS_FRAMES, 0)
+                    continue
+                time.sleep(0.1)
+                continue
+            self.frame = frame
+            self.frame_id += 1
+            if self.is_file:
+                time.sleep(1/self.fps)
+        self.vc.release()
+
+    def stop(self):
+        self.running = False
+
+
+sources: typing.Dict[str, CaptureSource] = {}
+
+
+def open_sources(config: typing.List[dict]):
+    # sources must look like this: [{'name': str, 'source': int|str}]
+    for source_config in config:
+        source = CaptureSource(source_config['source'], source_config.get('name'))
+        sources[source.name] = source
+
+
+def close_sources():
+    for source in sources.values():
+        source.stop()
+    sources.clear()
+
+
+def latest_frame(name: str) -> typing.Optional[ndarray]:
+    source = sources.get(name)
+    if source is None:
+        return None
+    return source.frame
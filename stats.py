@@ -0,0 +1,148 @@
+import os
+import random
+import time
+import tracemalloc
+import typing
+
+from filters import Filter, FilterPack
+
+
+class FilterMemory:
+    '''Memory counters of a single filter for the current log interval'''
+
+    def __init__(self):
+        self.frames = 0
+        self.peak = 0       # the biggest amount of bytes allocated during one frame
+        self.total = 0      # sum of per frame peaks
+        self.retained = 0   # bytes that were allocated and not freed after the filter returned
+        self.cached = 0     # resident size of the filter's cached state
+        self.mapped = 0     # size of memory-mapped assets, shared with other processes and paged in on demand
+
+    def as_dict(self) -> typing.Dict[str, int]:
+        return {
+            'frames': self.frames,
+            'peak': self.peak,
+            'average': self.total // self.frames if self.frames else 0,
+            'total': self.total,
+            'retained': self.retained,
+            'cached': self.cached,
+            'mapped': self.mapped,
+        }
+
+
+def format_bytes(size: int) -> str:
+    for unit in ['B', 'KB', 'MB']:
+        if abs(size) < 1024:
+            return f'{size:.0f}{unit}'
+        size /= 1024
+    return f'{size:.1f}GB'
+
+
+# allocations, made by the code of these files, belong to filters
+FILTER_FILES = ['filters.py', 'regions.py', 'assets.py']
+
+
+def filter_name(filter: Filter) -> str:
+    # filters without a name are told apart by their id
+    return filter.name or f'{type(filter).__name__}@{id(filter):x}'
+
+
+class MemoryStats:
+    '''
+    Opt-in memory instrumentation of filters, based on tracemalloc
+
+    Args:
+        log_interval (float): seconds between two reports in the log
+        budgets (dict[str, int]): maximum bytes allowed per frame for filter names.
+            Filters are named after their buttons, filters inside a `FilterPack` are named "pack name/filter name"
+
+    tracemalloc counts allocations of all threads, so capture, warm-up and metrics threads are added to the
+    filter, which is running at that moment. If budgets are set, retained memory is taken from snapshots and
+    only allocations, made from the filter files, are counted. This is slower, and peak is still counted for all threads
+
+    Functions:
+        measure: run filter._apply and record memory, allocated by it
+        end_frame: update cached state sizes and print a report if it is time
+        report: get current counters as a dictionary
+
+    Attributes:
+        last_report (dict): counters of the last finished log interval, also served by the metrics endpoint
+    '''
+
+    def __init__(self, log_interval: float = 5, budgets: typing.Dict[str, int] = None):
+        self.log_interval = log_interval
+        self.budgets = budgets or {}
+        self.filters: typing.Dict[str, FilterMemory] = {}
+        self.last_report = {}
+        self.last_log = time.monotonic()
+        self.trace_filters = None
+        if self.budgets:
+            # tracebacks must be long enough to reach the filter code from numpy and OpenCV calls
+            tracemalloc.stop()
+            tracemalloc.start(25)
+            self.trace_filters = [tracemalloc.Filter(True, f'*{os.sep}{name}', all_frames=True)
+                                  for name in FILTER_FILES]
+        elif not tracemalloc.is_tracing():
+            tracemalloc.start()
+
+    def measure(self, filter: Filter, frame, gui, prefix: str = ''):
+        name = prefix + filter_name(filter)
+        if isinstance(filter, FilterPack):
+            # measure every filter of the pack separately
+            if filter.chance >= 100 or filter.chance >= random.random() * 100:
+                filter.modify_gui(gui)
+                return filter.apply(frame, gui, lambda child, frame, gui: self.measure(child, frame, gui, f'{name}/'))
+            return None
+
+        snapshot = self.take_snapshot()
+        tracemalloc.reset_peak()
+        before, _ = tracemalloc.get_traced_memory()
+        new_frame = filter._apply(frame, gui)
+        current, peak = tracemalloc.get_traced_memory()
+        if snapshot is not None:
+            differences = self.take_snapshot().compare_to(snapshot, 'filename')
+            retained = sum(difference.size_diff for difference in differences)
+        else:
+            retained = current - before
+
+        stats = self.filters.setdefault(name, FilterMemory())
+        stats.frames += 1
+        stats.peak = max(stats.peak, peak - before)
+        stats.total += peak - before
+        stats.retained += max(retained, 0)
+        return new_frame
+
+    def take_snapshot(self) -> typing.Optional[tracemalloc.Snapshot]:
+        if self.trace_filters is None:
+            return None
+        return tracemalloc.take_snapshot().filter_traces(self.trace_filters)
+
+    def end_frame(self, filters: typing.Iterable[Filter], prefix: str = ''):
+        for filter in filters:
+            name = prefix + filter_name(filter)
+            if isinstance(filter, FilterPack):
+                self.end_frame(filter.filters, f'{name}/')
+                continue
+            stats = self.filters.setdefault(name, FilterMemory())
+            stats.cached = filter.cached_bytes()
+            stats.mapped = filter.mapped_bytes()
+
+        if not prefix and time.monotonic() - self.last_log >= self.log_interval:
+            self.log()
+
+    def report(self) -> typing.Dict[str, typing.Dict[str, int]]:
+        return {name: stats.as_dict() for name, stats in self.filters.items()}
+
+    def log(self):
+        self.last_report = self.report()
+        for name, stats in self.last_report.items():
+            print(f'[memory] {name}: peak {format_bytes(stats["peak"])}, '
+                  f'average {format_bytes(stats["average"])}/frame, '
+                  f'retained {format_bytes(stats["retained"])}, '
+                  f'cached {format_bytes(stats["cached"])}, '
+                  f'mapped {format_bytes(stats["mapped"])}')
+            budget = self.budgets.get(name)
+            if budget is not None and max(stats['peak'], stats['cached']) > budget:
+                print(f'[memory] {name} is over its budget of {format_bytes(budget)}')
+        self.filters = {}
+        self.last_log = time.monotonic()